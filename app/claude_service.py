@@ -1,41 +1,30 @@
 import anthropic
 import os
 import json
-import re
-from typing import List, Dict, Any, Optional
+import hashlib
+import time
+import orjson
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator
 from fastapi import HTTPException
 import logging
 
 logger = logging.getLogger(__name__)
 
-class ClaudeSubscriptionDetector:
-    def __init__(self):
-        api_key = os.getenv("CLAUDE_API_KEY")
-        if not api_key:
-            logger.warning("CLAUDE_API_KEY not found, using mock detection")
-            self.client = None
-        else:
-            self.client = anthropic.Anthropic(api_key=api_key)
-    
-    async def analyze_bank_statement(self, statement_text: str) -> List[Dict[str, Any]]:
-        """Analyze bank statement text to detect subscriptions"""
-        if not self.client:
-            return self._get_mock_subscriptions()
-        
-        prompt = f"""
+_PROMPT_PREFIX = """
         Analyze this bank statement and identify recurring subscription charges.
         Look for patterns like monthly/yearly charges from the same merchant.
         
         For each subscription found, provide ONLY a JSON array with this exact format:
         [
-          {{
+          {
             "name": "Service name",
             "company": "Company name",
             "amount": 15.99,
             "billing_cycle": "monthly",
             "category": "streaming",
             "confidence": 0.95
-          }}
+          }
         ]
         
         Categories must be one of: streaming, software, utilities, fitness, insurance, telecom, news, gaming, other
@@ -43,10 +32,109 @@ class ClaudeSubscriptionDetector:
         Confidence should be between 0.0 and 1.0
         
         Bank statement text:
-        {statement_text}
+        """
+
+_PROMPT_SUFFIX = """
         
         Return ONLY the JSON array, no other text.
         """
+
+_MAX_RESPONSE_CHARS = 100_000
+
+_RESULT_CACHE_TTL_SECONDS = 24 * 60 * 60
+_RESULT_CACHE_MAX_ENTRIES = 1024
+
+_REQUIRED_FIELDS = frozenset({'name', 'company', 'amount', 'billing_cycle', 'category', 'confidence'})
+_VALID_CATEGORIES = frozenset({'streaming', 'software', 'utilities', 'fitness', 'insurance', 'telecom', 'news', 'gaming', 'other'})
+_VALID_CYCLES = frozenset({'monthly', 'yearly', 'weekly'})
+_CATEGORY_MAP = {category: category for category in _VALID_CATEGORIES}
+_CYCLE_MAP = {cycle: cycle for cycle in _VALID_CYCLES}
+
+_MOCK_SUBSCRIPTIONS: List[Dict[str, Any]] = [
+    {
+        "name": "Amazon Prime",
+        "company": "Amazon",
+        "amount": 14.99,
+        "billing_cycle": "monthly",
+        "category": "streaming",
+        "confidence": 0.95
+    },
+    {
+        "name": "Microsoft 365",
+        "company": "Microsoft",
+        "amount": 6.99,
+        "billing_cycle": "monthly",
+        "category": "software",
+        "confidence": 0.88
+    }
+]
+
+class _JSONArraySplitter:
+    """Incrementally split streamed text into the top-level objects of its first JSON array"""
+    def __init__(self):
+        self.found_array = False
+        self._done = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._buffer: List[str] = []
+    
+    def feed(self, text: str) -> List[str]:
+        objects = []
+        for char in text:
+            if self._done:
+                break
+            if not self.found_array:
+                self.found_array = char == '['
+                continue
+            if self._depth == 0:
+                if char == '{':
+                    self._depth = 1
+                    self._buffer = [char]
+                elif char == ']':
+                    self._done = True
+                continue
+            
+            self._buffer.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == '{':
+                self._depth += 1
+            elif char == '}':
+                self._depth -= 1
+                if self._depth == 0:
+                    objects.append(''.join(self._buffer))
+        return objects
+
+class ClaudeSubscriptionDetector:
+    def __init__(self):
+        api_key = os.getenv("CLAUDE_API_KEY")
+        if not api_key:
+            logger.warning("CLAUDE_API_KEY not found, using mock detection")
+            self.client = None
+        else:
+            self.client = anthropic.AsyncAnthropic(api_key=api_key, max_retries=2, timeout=30.0)
+        
+        self._result_cache: "OrderedDict[str, Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+    
+    async def analyze_bank_statement(self, statement_text: str) -> List[Dict[str, Any]]:
+        """Analyze bank statement text to detect subscriptions"""
+        if not self.client:
+            return self._get_mock_subscriptions()
+        
+        cache_key = hashlib.sha256(statement_text.encode('utf-8')).hexdigest()
+        cached = self._get_cached_result(cache_key)
+        if cached is not None:
+            return cached
+        
+        prompt = _PROMPT_PREFIX + statement_text + _PROMPT_SUFFIX
         
         try:
             response = await self.client.messages.create(
@@ -56,19 +144,89 @@ class ClaudeSubscriptionDetector:
             )
             
             content = response.content[0].text if response.content else ""
-            return self._parse_claude_response(content)
+            subscriptions = self._parse_claude_response(content)
+            if subscriptions is not _MOCK_SUBSCRIPTIONS:
+                self._set_cached_result(cache_key, subscriptions)
+            return subscriptions
             
         except Exception as e:
             logger.error(f"Claude AI analysis failed: {str(e)}")
             return self._get_mock_subscriptions()
     
+    async def stream_bank_statement(self, statement_text: str) -> AsyncIterator[Dict[str, Any]]:
+        """Yield detected subscriptions as soon as each one is complete in Claude's output"""
+        if not self.client:
+            for sub in self._get_mock_subscriptions():
+                yield sub
+            return
+        
+        cache_key = hashlib.sha256(statement_text.encode('utf-8')).hexdigest()
+        cached = self._get_cached_result(cache_key)
+        if cached is not None:
+            for sub in cached:
+                yield sub
+            return
+        
+        prompt = _PROMPT_PREFIX + statement_text + _PROMPT_SUFFIX
+        splitter = _JSONArraySplitter()
+        detected_subscriptions = []
+        
+        try:
+            async with self.client.messages.stream(
+                model="claude-3-sonnet-20240229",
+                max_tokens=1000,
+                messages=[{"role": "user", "content": prompt}]
+            ) as stream:
+                async for text in stream.text_stream:
+                    for raw_subscription in splitter.feed(text):
+                        sub = orjson.loads(raw_subscription)
+                        if self._validate_subscription(sub):
+                            detected_subscriptions.append(sub)
+                            yield sub
+        
+        except Exception as e:
+            logger.error(f"Claude AI streaming analysis failed: {str(e)}")
+            if not detected_subscriptions:
+                for sub in self._get_mock_subscriptions():
+                    yield sub
+            return
+        
+        if not splitter.found_array:
+            logger.warning("No JSON array found in Claude response")
+            for sub in self._get_mock_subscriptions():
+                yield sub
+            return
+        
+        self._set_cached_result(cache_key, detected_subscriptions)
+    
+    def _get_cached_result(self, cache_key: str) -> Optional[List[Dict[str, Any]]]:
+        entry = self._result_cache.get(cache_key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._result_cache[cache_key]
+            return None
+        self._result_cache.move_to_end(cache_key)
+        return entry[1]
+    
+    def _set_cached_result(self, cache_key: str, subscriptions: List[Dict[str, Any]]) -> None:
+        self._result_cache[cache_key] = (time.monotonic() + _RESULT_CACHE_TTL_SECONDS, subscriptions)
+        self._result_cache.move_to_end(cache_key)
+        if len(self._result_cache) > _RESULT_CACHE_MAX_ENTRIES:
+            self._result_cache.popitem(last=False)
+    
     def _parse_claude_response(self, content: str) -> List[Dict[str, Any]]:
         """Parse Claude's response and extract subscription data"""
+        if len(content) > _MAX_RESPONSE_CHARS:
+            logger.warning(f"Claude response too large to parse ({len(content)} chars)")
+            return self._get_mock_subscriptions()
+        
         try:
-            json_match = re.search(r'\[.*\]', content, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(0)
-                subscriptions = json.loads(json_str)
+            start = content.find('[')
+            end = content.rfind(']')
+            if start >= 0 and end > start:
+                json_str = content[start:end + 1]
+                subscriptions = orjson.loads(json_str)
                 
                 validated_subscriptions = []
                 for sub in subscriptions:
@@ -86,51 +244,23 @@ class ClaudeSubscriptionDetector:
     
     def _validate_subscription(self, sub: Dict[str, Any]) -> bool:
         """Validate subscription data structure"""
-        required_fields = ['name', 'company', 'amount', 'billing_cycle', 'category', 'confidence']
-        valid_categories = ['streaming', 'software', 'utilities', 'fitness', 'insurance', 'telecom', 'news', 'gaming', 'other']
-        valid_cycles = ['monthly', 'yearly', 'weekly']
+        if not isinstance(sub, dict) or not _REQUIRED_FIELDS.issubset(sub):
+            return False
         
-        try:
-            for field in required_fields:
-                if field not in sub:
-                    return False
-            
-            if sub['category'] not in valid_categories:
-                sub['category'] = 'other'
-            
-            if sub['billing_cycle'] not in valid_cycles:
-                sub['billing_cycle'] = 'monthly'
-            
-            if not isinstance(sub['amount'], (int, float)) or sub['amount'] <= 0:
-                return False
-            
-            if not isinstance(sub['confidence'], (int, float)) or not (0 <= sub['confidence'] <= 1):
-                sub['confidence'] = 0.8
-            
-            return True
-            
-        except Exception:
+        category, billing_cycle = sub['category'], sub['billing_cycle']
+        sub['category'] = _CATEGORY_MAP.get(category, 'other') if isinstance(category, str) else 'other'
+        sub['billing_cycle'] = _CYCLE_MAP.get(billing_cycle, 'monthly') if isinstance(billing_cycle, str) else 'monthly'
+        
+        if not isinstance(sub['amount'], (int, float)) or sub['amount'] <= 0:
             return False
+        
+        if not isinstance(sub['confidence'], (int, float)) or not (0 <= sub['confidence'] <= 1):
+            sub['confidence'] = 0.8
+        
+        return True
     
     def _get_mock_subscriptions(self) -> List[Dict[str, Any]]:
         """Fallback mock subscriptions when Claude AI is not available"""
-        return [
-            {
-                "name": "Amazon Prime",
-                "company": "Amazon",
-                "amount": 14.99,
-                "billing_cycle": "monthly",
-                "category": "streaming",
-                "confidence": 0.95
-            },
-            {
-                "name": "Microsoft 365",
-                "company": "Microsoft",
-                "amount": 6.99,
-                "billing_cycle": "monthly", 
-                "category": "software",
-                "confidence": 0.88
-            }
-        ]
+        return _MOCK_SUBSCRIPTIONS
 
 claude_detector = ClaudeSubscriptionDetector()
@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, List
 from app.models import Currency
 
 EXCHANGE_RATES: Dict[str, float] = {
@@ -21,12 +21,19 @@ CURRENCY_SYMBOLS: Dict[str, str] = {
     "JPY": "¥"
 }
 
+_PAIR_RATES: Dict[str, Dict[str, float]] = {
+    from_currency: {
+        to_currency: EXCHANGE_RATES[to_currency] / EXCHANGE_RATES[from_currency]
+        for to_currency in EXCHANGE_RATES
+    }
+    for from_currency in EXCHANGE_RATES
+}
+
 def convert_currency(amount: float, from_currency: str, to_currency: str) -> float:
     if from_currency == to_currency:
         return amount
     
-    usd_amount = amount / EXCHANGE_RATES[from_currency]
-    return usd_amount * EXCHANGE_RATES[to_currency]
+    return amount * _PAIR_RATES[from_currency][to_currency]
 
 def format_currency(amount: float, currency: str) -> str:
     symbol = CURRENCY_SYMBOLS.get(currency, currency)
@@ -42,3 +49,5 @@ def get_currency_info(currency: str) -> Dict[str, str]:
         "symbol": CURRENCY_SYMBOLS.get(currency, currency),
         "rate": str(EXCHANGE_RATES.get(currency, 1.0))
     }
+
+SUPPORTED_CURRENCIES: List[Dict[str, str]] = [get_currency_info(currency.value) for currency in Currency]
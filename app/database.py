@@ -1,7 +1,14 @@
-from typing import Dict, List, Optional
-from app.models import User, Subscription, BillNegotiation, PriceAlert, SavingsReport, Currency, Payment, UserPlan, PaymentStatus
-import uuid
+from typing import Any, Dict, List, Optional, Tuple
+from app.models import User, Subscription, BillNegotiation, PriceAlert, SavingsReport, Currency, Payment, UserPlan, PaymentStatus, SubscriptionStatus, BillStatus, UserStats
+from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta
+import time
+
+_SUBSCRIPTION_FIELDS = frozenset(Subscription.model_fields)
+_NEGOTIATION_FIELDS = frozenset(BillNegotiation.model_fields)
+
+_REPORT_CACHE_TTL_SECONDS = 60.0
+_REPORT_CACHE_MAX_ENTRIES = 4096
 
 class InMemoryDatabase:
     def __init__(self):
@@ -11,6 +18,15 @@ class InMemoryDatabase:
         self.price_alerts: Dict[str, PriceAlert] = {}
         self.payments: Dict[str, Payment] = {}
         
+        self._users_by_email: Dict[str, User] = {}
+        self._subs_by_user: Dict[str, Dict[str, Subscription]] = defaultdict(dict)
+        self._subs_by_user_status: Dict[Tuple[str, SubscriptionStatus], Dict[str, Subscription]] = defaultdict(dict)
+        self._negotiations_by_user: Dict[str, Dict[str, BillNegotiation]] = defaultdict(dict)
+        self._alerts_by_user: Dict[str, Dict[str, PriceAlert]] = defaultdict(dict)
+        self._payments_by_user: Dict[str, Dict[str, Payment]] = defaultdict(dict)
+        self._user_stats: Dict[str, UserStats] = {}
+        self._report_cache: "OrderedDict[Tuple[str, str], Tuple[float, Any]]" = OrderedDict()
+        
         self._initialize_sample_data()
     
     def _initialize_sample_data(self):
@@ -25,7 +41,7 @@ class InMemoryDatabase:
             ai_detections_used=1,
             ai_detections_limit=2
         )
-        self.users[sample_user.id] = sample_user
+        self.create_user(sample_user)
         
         sample_subscriptions = [
             Subscription(
@@ -71,7 +87,7 @@ class InMemoryDatabase:
                 next_billing_date=datetime.utcnow() + timedelta(days=5),
                 category="fitness",
                 last_used=datetime.utcnow() - timedelta(days=30),
-                status="active"
+                status=SubscriptionStatus.ACTIVE
             ),
             Subscription(
                 id="sub-5",
@@ -83,77 +99,172 @@ class InMemoryDatabase:
                 next_billing_date=datetime.utcnow() + timedelta(days=12),
                 category="streaming",
                 last_used=datetime.utcnow() - timedelta(days=60),
-                status="active"
+                status=SubscriptionStatus.ACTIVE
             )
         ]
         
         for sub in sample_subscriptions:
-            self.subscriptions[sub.id] = sub
+            self.create_subscription(sub)
     
     def create_user(self, user: User) -> User:
         self.users[user.id] = user
+        self._users_by_email[user.email.casefold()] = user
         return user
     
     def get_user(self, user_id: str) -> Optional[User]:
         return self.users.get(user_id)
     
     def get_user_by_email(self, email: str) -> Optional[User]:
-        for user in self.users.values():
-            if user.email == email:
-                return user
-        return None
+        return self._users_by_email.get(email.casefold())
     
     def create_subscription(self, subscription: Subscription) -> Subscription:
         self.subscriptions[subscription.id] = subscription
+        self._subs_by_user[subscription.user_id][subscription.id] = subscription
+        self._subs_by_user_status[(subscription.user_id, subscription.status)][subscription.id] = subscription
+        self._refresh_user_stats(subscription.user_id)
         return subscription
     
     def get_subscription(self, subscription_id: str) -> Optional[Subscription]:
         return self.subscriptions.get(subscription_id)
     
-    def get_user_subscriptions(self, user_id: str) -> List[Subscription]:
-        return [sub for sub in self.subscriptions.values() if sub.user_id == user_id]
+    def get_user_subscriptions(
+        self,
+        user_id: str,
+        status: Optional[SubscriptionStatus] = None,
+        last_used_before: Optional[datetime] = None
+    ) -> List[Subscription]:
+        if status is None:
+            subscriptions = self._subs_by_user.get(user_id, {}).values()
+        else:
+            subscriptions = self._subs_by_user_status.get((user_id, status), {}).values()
+        
+        if last_used_before is None:
+            return list(subscriptions)
+        
+        return [
+            sub for sub in subscriptions
+            if sub.last_used is not None and sub.last_used < last_used_before
+        ]
+    
+    def get_subscriptions_for_users(self, user_ids: List[str]) -> Dict[str, List[Subscription]]:
+        subs_by_user = self._subs_by_user
+        return {
+            user_id: list(subs_by_user[user_id].values()) if user_id in subs_by_user else []
+            for user_id in user_ids
+        }
     
     def update_subscription(self, subscription_id: str, updates: dict) -> Optional[Subscription]:
         if subscription_id in self.subscriptions:
             subscription = self.subscriptions[subscription_id]
-            for key, value in updates.items():
-                if hasattr(subscription, key):
-                    setattr(subscription, key, value)
+            old_user_id, old_status = subscription.user_id, subscription.status
+            subscription.__dict__.update({key: value for key, value in updates.items() if key in _SUBSCRIPTION_FIELDS})
             subscription.updated_at = datetime.utcnow()
+            
+            if subscription.user_id != old_user_id:
+                self._subs_by_user[old_user_id].pop(subscription_id, None)
+                self._subs_by_user[subscription.user_id][subscription_id] = subscription
+                self._refresh_user_stats(old_user_id)
+            if subscription.user_id != old_user_id or subscription.status != old_status:
+                self._subs_by_user_status[(old_user_id, old_status)].pop(subscription_id, None)
+                self._subs_by_user_status[(subscription.user_id, subscription.status)][subscription_id] = subscription
+            
+            self._refresh_user_stats(subscription.user_id)
             return subscription
         return None
     
     def delete_subscription(self, subscription_id: str) -> bool:
-        if subscription_id in self.subscriptions:
-            del self.subscriptions[subscription_id]
+        subscription = self.subscriptions.pop(subscription_id, None)
+        if subscription is not None:
+            self._subs_by_user[subscription.user_id].pop(subscription_id, None)
+            self._subs_by_user_status[(subscription.user_id, subscription.status)].pop(subscription_id, None)
+            self._refresh_user_stats(subscription.user_id)
             return True
         return False
     
+    def _refresh_user_stats(self, user_id: str) -> None:
+        subscriptions = self._subs_by_user.get(user_id, {})
+        active_status = SubscriptionStatus.ACTIVE
+        
+        stats = UserStats(user_id=user_id, total_subscriptions=len(subscriptions))
+        categories = defaultdict(lambda: [0, 0])
+        for sub in subscriptions.values():
+            if sub.status != active_status:
+                continue
+            
+            amount = sub.amount
+            stats.active_subscriptions += 1
+            if sub.billing_cycle == "monthly":
+                stats.total_monthly += amount
+            elif sub.billing_cycle == "yearly":
+                stats.total_yearly += amount
+            
+            category = categories[sub.category]
+            category[0] += 1
+            category[1] += amount
+        
+        stats.category_breakdown = {
+            category: {"count": count, "total": total}
+            for category, (count, total) in categories.items()
+        }
+        self._user_stats[user_id] = stats
+        self._invalidate_user_reports(user_id)
+    
+    def get_user_stats(self, user_id: str) -> UserStats:
+        stats = self._user_stats.get(user_id)
+        if stats is None:
+            return UserStats(user_id=user_id)
+        return stats
+    
+    def get_cached_report(self, namespace: str, user_id: str) -> Optional[Any]:
+        cache_key = (namespace, user_id)
+        entry = self._report_cache.get(cache_key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._report_cache[cache_key]
+            return None
+        self._report_cache.move_to_end(cache_key)
+        return entry[1]
+    
+    def set_cached_report(self, namespace: str, user_id: str, report: Any) -> Any:
+        cache_key = (namespace, user_id)
+        self._report_cache[cache_key] = (time.monotonic() + _REPORT_CACHE_TTL_SECONDS, report)
+        self._report_cache.move_to_end(cache_key)
+        if len(self._report_cache) > _REPORT_CACHE_MAX_ENTRIES:
+            self._report_cache.popitem(last=False)
+        return report
+    
+    def _invalidate_user_reports(self, user_id: str) -> None:
+        self._report_cache.pop(("insights", user_id), None)
+        self._report_cache.pop(("savings", user_id), None)
+    
     def create_bill_negotiation(self, negotiation: BillNegotiation) -> BillNegotiation:
         self.bill_negotiations[negotiation.id] = negotiation
+        self._negotiations_by_user[negotiation.user_id][negotiation.id] = negotiation
+        self._invalidate_user_reports(negotiation.user_id)
         return negotiation
     
     def get_bill_negotiation(self, negotiation_id: str) -> Optional[BillNegotiation]:
         return self.bill_negotiations.get(negotiation_id)
     
     def get_user_negotiations(self, user_id: str) -> List[BillNegotiation]:
-        return [neg for neg in self.bill_negotiations.values() if neg.user_id == user_id]
+        return list(self._negotiations_by_user.get(user_id, {}).values())
     
     def update_bill_negotiation(self, negotiation_id: str, updates: dict) -> Optional[BillNegotiation]:
         if negotiation_id in self.bill_negotiations:
             negotiation = self.bill_negotiations[negotiation_id]
-            for key, value in updates.items():
-                if hasattr(negotiation, key):
-                    setattr(negotiation, key, value)
+            negotiation.__dict__.update({key: value for key, value in updates.items() if key in _NEGOTIATION_FIELDS})
+            self._invalidate_user_reports(negotiation.user_id)
             return negotiation
         return None
     
     def create_price_alert(self, alert: PriceAlert) -> PriceAlert:
         self.price_alerts[alert.id] = alert
+        self._alerts_by_user[alert.user_id][alert.id] = alert
         return alert
     
     def get_user_price_alerts(self, user_id: str) -> List[PriceAlert]:
-        return [alert for alert in self.price_alerts.values() if alert.user_id == user_id]
+        return list(self._alerts_by_user.get(user_id, {}).values())
     
     def acknowledge_price_alert(self, alert_id: str) -> bool:
         if alert_id in self.price_alerts:
@@ -162,35 +273,49 @@ class InMemoryDatabase:
         return False
     
     def get_user_savings_report(self, user_id: str) -> SavingsReport:
-        user_subscriptions = self.get_user_subscriptions(user_id)
-        user_negotiations = self.get_user_negotiations(user_id)
+        user_subscriptions = self._subs_by_user.get(user_id, {})
+        user_negotiations = self._negotiations_by_user.get(user_id, {})
         
-        active_subs = [sub for sub in user_subscriptions if sub.status == "active"]
-        cancelled_subs = [sub for sub in user_subscriptions if sub.status == "cancelled"]
-        completed_negotiations = [neg for neg in user_negotiations if neg.status == "completed"]
+        active_status = SubscriptionStatus.ACTIVE
+        cancelled_status = SubscriptionStatus.CANCELLED
+        completed_status = BillStatus.COMPLETED
         
-        monthly_savings = sum(neg.savings_potential or 0 for neg in completed_negotiations)
-        monthly_savings += sum(sub.amount for sub in cancelled_subs)
+        active = cancelled = 0
+        monthly_savings = 0.0
+        for sub in user_subscriptions.values():
+            status = sub.status
+            if status == active_status:
+                active += 1
+            elif status == cancelled_status:
+                cancelled += 1
+                monthly_savings += sub.amount
+        
+        completed_negotiations = 0
+        for neg in user_negotiations.values():
+            if neg.status == completed_status:
+                completed_negotiations += 1
+                monthly_savings += neg.savings_potential or 0
         
         return SavingsReport(
             user_id=user_id,
             monthly_savings=monthly_savings,
             yearly_savings=monthly_savings * 12,
-            cancelled_subscriptions=len(cancelled_subs),
-            negotiated_bills=len(completed_negotiations),
+            cancelled_subscriptions=cancelled,
+            negotiated_bills=completed_negotiations,
             total_subscriptions=len(user_subscriptions),
-            active_subscriptions=len(active_subs)
+            active_subscriptions=active
         )
     
     def create_payment(self, payment: Payment) -> Payment:
         self.payments[payment.id] = payment
+        self._payments_by_user[payment.user_id][payment.id] = payment
         return payment
     
     def get_payment(self, payment_id: str) -> Optional[Payment]:
         return self.payments.get(payment_id)
     
     def get_user_payments(self, user_id: str) -> List[Payment]:
-        return [payment for payment in self.payments.values() if payment.user_id == user_id]
+        return list(self._payments_by_user.get(user_id, {}).values())
     
     def update_payment(self, payment_id: str, updates: dict) -> Optional[Payment]:
         if payment_id in self.payments:
@@ -205,9 +330,13 @@ class InMemoryDatabase:
     def update_user(self, user_id: str, updates: dict) -> Optional[User]:
         if user_id in self.users:
             user = self.users[user_id]
+            old_email = user.email
             for key, value in updates.items():
                 if hasattr(user, key):
                     setattr(user, key, value)
+            if user.email != old_email:
+                self._users_by_email.pop(old_email.casefold(), None)
+                self._users_by_email[user.email.casefold()] = user
             return user
         return None
     
@@ -230,5 +359,20 @@ class InMemoryDatabase:
             user.ai_detections_used += 1
         
         return True
+    
+    def reserve_ai_usage(self, user_id: str) -> bool:
+        if not self.can_use_ai_detection(user_id):
+            return False
+        return self.increment_ai_usage(user_id)
+    
+    def release_ai_usage(self, user_id: str) -> bool:
+        user = self.get_user(user_id)
+        if not user:
+            return False
+        
+        if user.plan == UserPlan.free and user.ai_detections_used > 0:
+            user.ai_detections_used -= 1
+        
+        return True
 
 db = InMemoryDatabase()
@@ -1,36 +1,58 @@
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Optional
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from typing import Dict, List, Optional
 from datetime import datetime, timedelta
-import uuid
-import aiofiles
-import magic
+import asyncio
+import codecs
+import hashlib
 import os
+import orjson
 
 from app.models import (
-    User, UserCreate, Subscription, SubscriptionCreate, 
+    User, UserCreate, Subscription, SubscriptionCreate, BatchSubscriptionsRequest,
     BillNegotiation, BillNegotiationCreate, PriceAlert, 
     SavingsReport, SubscriptionStatus, BillStatus,
     Payment, PaymentCreate, UserPlan, PaymentStatus
 )
 from app.database import db
+from app.currency import SUPPORTED_CURRENCIES
 from app.claude_service import claude_detector
 from app.stripe_service import stripe_service
 
-app = FastAPI(title="Smart Subscription Manager API", version="1.0.0")
+app = FastAPI(title="Smart Subscription Manager API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Disable CORS. Do not remove this for full-stack development.
+# Set FRONTEND_ORIGINS (comma-separated) to restrict origins in production.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Allows all origins
+    allow_origins=[origin.strip() for origin in os.getenv("FRONTEND_ORIGINS", "*").split(",") if origin.strip()],
     allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"],  # Allows all headers
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["authorization", "content-type"],
+    max_age=86400,
 )
 
+_HEALTH_BODY = orjson.dumps({"status": "ok"})
+_CURRENCIES_BODY = orjson.dumps(SUPPORTED_CURRENCIES)
+_CURRENCIES_HEADERS = {
+    "ETag": f'"{hashlib.sha256(_CURRENCIES_BODY).hexdigest()[:32]}"',
+    "Cache-Control": "public, max-age=86400"
+}
+
+_MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+_UPLOAD_CHUNK_SIZE = 64 * 1024
+_AI_ANALYSIS_TIMEOUT_SECONDS = 90.0
+
+async def valid_user_id(user_id: str) -> User:
+    user = db.get_user(user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
 @app.get("/healthz")
 async def healthz():
-    return {"status": "ok"}
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 @app.post("/api/users", response_model=User)
 async def create_user(user_data: UserCreate):
@@ -38,14 +60,11 @@ async def create_user(user_data: UserCreate):
     if existing_user:
         raise HTTPException(status_code=400, detail="User with this email already exists")
     
-    user = User(**user_data.dict())
+    user = User.model_construct(**user_data.model_dump())
     return db.create_user(user)
 
 @app.get("/api/users/{user_id}", response_model=User)
-async def get_user(user_id: str):
-    user = db.get_user(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+async def get_user(user: User = Depends(valid_user_id)):
     return user
 
 @app.get("/api/users/email/{email}", response_model=User)
@@ -55,20 +74,17 @@ async def get_user_by_email(email: str):
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
+@app.post("/api/users/batch/subscriptions", response_model=Dict[str, List[Subscription]])
+async def get_subscriptions_for_users(request_data: BatchSubscriptionsRequest):
+    return db.get_subscriptions_for_users(request_data.user_ids)
+
 @app.get("/api/users/{user_id}/subscriptions", response_model=List[Subscription])
-async def get_user_subscriptions(user_id: str):
-    user = db.get_user(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    return db.get_user_subscriptions(user_id)
+async def get_user_subscriptions(user: User = Depends(valid_user_id)):
+    return db.get_user_subscriptions(user.id)
 
 @app.post("/api/users/{user_id}/subscriptions", response_model=Subscription)
-async def create_subscription(user_id: str, subscription_data: SubscriptionCreate):
-    user = db.get_user(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    subscription = Subscription(user_id=user_id, **subscription_data.dict())
+async def create_subscription(subscription_data: SubscriptionCreate, user: User = Depends(valid_user_id)):
+    subscription = Subscription.model_construct(user_id=user.id, **subscription_data.model_dump())
     return db.create_subscription(subscription)
 
 @app.get("/api/subscriptions/{subscription_id}", response_model=Subscription)
@@ -115,19 +131,12 @@ async def delete_subscription(subscription_id: str):
     return {"message": "Subscription deleted successfully"}
 
 @app.get("/api/users/{user_id}/negotiations", response_model=List[BillNegotiation])
-async def get_user_negotiations(user_id: str):
-    user = db.get_user(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    return db.get_user_negotiations(user_id)
+async def get_user_negotiations(user: User = Depends(valid_user_id)):
+    return db.get_user_negotiations(user.id)
 
 @app.post("/api/users/{user_id}/negotiations", response_model=BillNegotiation)
-async def create_bill_negotiation(user_id: str, negotiation_data: BillNegotiationCreate):
-    user = db.get_user(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    negotiation = BillNegotiation(user_id=user_id, **negotiation_data.dict())
+async def create_bill_negotiation(negotiation_data: BillNegotiationCreate, user: User = Depends(valid_user_id)):
+    negotiation = BillNegotiation.model_construct(user_id=user.id, **negotiation_data.model_dump())
     negotiation.savings_potential = negotiation.current_amount * 0.15  # 15% average savings
     
     return db.create_bill_negotiation(negotiation)
@@ -151,34 +160,20 @@ async def complete_negotiation(negotiation_id: str, actual_savings: float):
     return {"message": "Negotiation completed successfully", "negotiation": updated}
 
 @app.get("/api/users/{user_id}/savings-report", response_model=SavingsReport)
-async def get_savings_report(user_id: str):
-    user = db.get_user(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    return db.get_user_savings_report(user_id)
+async def get_savings_report(user: User = Depends(valid_user_id)):
+    report = db.get_cached_report("savings", user.id)
+    if report is None:
+        report = db.set_cached_report("savings", user.id, db.get_user_savings_report(user.id))
+    return report
 
 @app.get("/api/users/{user_id}/unused-subscriptions", response_model=List[Subscription])
-async def get_unused_subscriptions(user_id: str, days_unused: int = 30):
-    user = db.get_user(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    subscriptions = db.get_user_subscriptions(user_id)
+async def get_unused_subscriptions(days_unused: int = 30, user: User = Depends(valid_user_id)):
     cutoff_date = datetime.utcnow() - timedelta(days=days_unused)
-    
-    unused = []
-    for sub in subscriptions:
-        if sub.status == SubscriptionStatus.ACTIVE and sub.last_used and sub.last_used < cutoff_date:
-            unused.append(sub)
-    
-    return unused
+    return db.get_user_subscriptions(user.id, status=SubscriptionStatus.ACTIVE, last_used_before=cutoff_date)
 
 @app.get("/api/users/{user_id}/price-alerts", response_model=List[PriceAlert])
-async def get_price_alerts(user_id: str):
-    user = db.get_user(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    return db.get_user_price_alerts(user_id)
+async def get_price_alerts(user: User = Depends(valid_user_id)):
+    return db.get_user_price_alerts(user.id)
 
 @app.put("/api/price-alerts/{alert_id}/acknowledge")
 async def acknowledge_price_alert(alert_id: str):
@@ -188,32 +183,30 @@ async def acknowledge_price_alert(alert_id: str):
     return {"message": "Price alert acknowledged"}
 
 @app.get("/api/currencies")
-async def get_supported_currencies():
-    from app.currency import get_currency_info
-    from app.models import Currency
-    try:
-        currencies = []
-        for currency in Currency:
-            currencies.append(get_currency_info(currency.value))
-        return currencies
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def get_supported_currencies(request: Request):
+    if request.headers.get("if-none-match") == _CURRENCIES_HEADERS["ETag"]:
+        return Response(status_code=304, headers=_CURRENCIES_HEADERS)
+    return Response(content=_CURRENCIES_BODY, media_type="application/json", headers=_CURRENCIES_HEADERS)
 
-def check_ai_access(user_id: str) -> User:
-    user = db.get_user(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    if not db.can_use_ai_detection(user_id):
-        raise HTTPException(
-            status_code=403, 
-            detail=f"AI detection limit reached ({user.ai_detections_used}/{user.ai_detections_limit}). Upgrade to Premium for unlimited access."
-        )
+def _ai_limit_exception(user: User) -> HTTPException:
+    return HTTPException(
+        status_code=403, 
+        detail=f"AI detection limit reached ({user.ai_detections_used}/{user.ai_detections_limit}). Upgrade to Premium for unlimited access."
+    )
+
+async def check_ai_access(user: User = Depends(valid_user_id)) -> User:
+    if not db.can_use_ai_detection(user.id):
+        raise _ai_limit_exception(user)
     return user
 
+def _reserve_ai_detection(user: User) -> None:
+    # Check and count in one step, before the handler's first await, so concurrent requests cannot overspend the quota
+    if not db.reserve_ai_usage(user.id):
+        raise _ai_limit_exception(user)
+
 @app.post("/api/users/{user_id}/detect-subscriptions")
-async def detect_subscriptions(user_id: str):
-    user = check_ai_access(user_id)
+async def detect_subscriptions(user: User = Depends(check_ai_access)):
+    _reserve_ai_detection(user)
     
     sample_statement = """
     BANK STATEMENT - RECENT TRANSACTIONS
@@ -228,8 +221,6 @@ async def detect_subscriptions(user_id: str):
     
     detected_subscriptions = await claude_detector.analyze_bank_statement(sample_statement)
     
-    db.increment_ai_usage(user_id)
-    
     return {
         "message": f"AI detected {len(detected_subscriptions)} potential subscriptions",
         "detected_subscriptions": detected_subscriptions,
@@ -237,28 +228,41 @@ async def detect_subscriptions(user_id: str):
         "remaining_detections": user.ai_detections_limit - user.ai_detections_used - 1 if user.plan == UserPlan.free else "unlimited"
     }
 
-@app.post("/api/users/{user_id}/upload-statement")
-async def upload_bank_statement(user_id: str, file: UploadFile = File(...)):
-    user = check_ai_access(user_id)
-    
-    if file.size > 10 * 1024 * 1024:
+def _check_statement_file(file: UploadFile) -> None:
+    if file.size is not None and file.size > _MAX_UPLOAD_BYTES:
         raise HTTPException(status_code=413, detail="File too large. Maximum size is 10MB.")
     
     allowed_types = ['text/plain', 'text/csv', 'application/pdf']
     if file.content_type not in allowed_types:
         raise HTTPException(status_code=400, detail="Unsupported file type. Please upload TXT, CSV, or PDF files.")
+
+async def _read_statement_text(file: UploadFile) -> str:
+    if file.content_type == 'application/pdf':
+        return "PDF processing not implemented yet. Using sample data."
+    
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    parts = []
+    total_bytes = 0
+    while chunk := await file.read(_UPLOAD_CHUNK_SIZE):
+        total_bytes += len(chunk)
+        if total_bytes > _MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="File too large. Maximum size is 10MB.")
+        parts.append(decoder.decode(chunk))
+    parts.append(decoder.decode(b"", final=True))
+    return "".join(parts)
+
+@app.post("/api/users/{user_id}/upload-statement")
+async def upload_bank_statement(file: UploadFile = File(...), user: User = Depends(check_ai_access)):
+    _reserve_ai_detection(user)
     
     try:
-        content = await file.read()
-        
-        if file.content_type == 'application/pdf':
-            statement_text = "PDF processing not implemented yet. Using sample data."
-        else:
-            statement_text = content.decode('utf-8')
-        
-        detected_subscriptions = await claude_detector.analyze_bank_statement(statement_text)
+        _check_statement_file(file)
+        statement_text = await _read_statement_text(file)
         
-        db.increment_ai_usage(user_id)
+        detected_subscriptions = await asyncio.wait_for(
+            claude_detector.analyze_bank_statement(statement_text),
+            timeout=_AI_ANALYSIS_TIMEOUT_SECONDS
+        )
         
         return {
             "message": f"Analyzed {file.filename} and detected {len(detected_subscriptions)} potential subscriptions",
@@ -268,53 +272,66 @@ async def upload_bank_statement(user_id: str, file: UploadFile = File(...)):
             "remaining_detections": user.ai_detections_limit - user.ai_detections_used - 1 if user.plan == UserPlan.free else "unlimited"
         }
         
+    except HTTPException:
+        db.release_ai_usage(user.id)
+        raise
+    except asyncio.TimeoutError:
+        db.release_ai_usage(user.id)
+        raise HTTPException(status_code=504, detail="AI analysis timed out. Please try again.")
     except Exception as e:
+        db.release_ai_usage(user.id)
         raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
 
-@app.get("/api/users/{user_id}/subscription-insights")
-async def get_subscription_insights(user_id: str):
-    user = db.get_user(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+@app.post("/api/users/{user_id}/upload-statement/stream")
+async def stream_bank_statement(file: UploadFile = File(...), user: User = Depends(check_ai_access)):
+    _reserve_ai_detection(user)
     
-    subscriptions = db.get_user_subscriptions(user_id)
-    
-    total_monthly = sum(sub.amount for sub in subscriptions if sub.status == "active" and sub.billing_cycle == "monthly")
-    total_yearly = sum(sub.amount for sub in subscriptions if sub.status == "active" and sub.billing_cycle == "yearly")
-    
-    category_breakdown = {}
-    for sub in subscriptions:
-        if sub.status == "active":
-            if sub.category not in category_breakdown:
-                category_breakdown[sub.category] = {"count": 0, "total": 0}
-            category_breakdown[sub.category]["count"] += 1
-            category_breakdown[sub.category]["total"] += sub.amount
+    try:
+        _check_statement_file(file)
+        statement_text = await _read_statement_text(file)
+    except HTTPException:
+        db.release_ai_usage(user.id)
+        raise
+    except Exception as e:
+        db.release_ai_usage(user.id)
+        raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
     
-    unused_count = len([sub for sub in subscriptions if sub.last_used and 
-                       (datetime.utcnow() - sub.last_used).days > 30])
+    async def detected_subscriptions():
+        async for subscription in claude_detector.stream_bank_statement(statement_text):
+            yield orjson.dumps(subscription) + b"\n"
     
-    return {
-        "total_monthly_cost": total_monthly,
-        "total_yearly_cost": total_yearly,
-        "annual_projection": (total_monthly * 12) + total_yearly,
-        "category_breakdown": category_breakdown,
+    return StreamingResponse(detected_subscriptions(), media_type="application/x-ndjson")
+
+@app.get("/api/users/{user_id}/subscription-insights")
+async def get_subscription_insights(user: User = Depends(valid_user_id)):
+    cached = db.get_cached_report("insights", user.id)
+    if cached is not None:
+        return cached
+    
+    stats = db.get_user_stats(user.id)
+    
+    # "more than 30 whole days" since last use, i.e. at least 31 days
+    unused_cutoff = datetime.utcnow() - timedelta(days=31)
+    unused_count = sum(1 for sub in db.get_user_subscriptions(user.id) if sub.last_used and sub.last_used <= unused_cutoff)
+    
+    return db.set_cached_report("insights", user.id, {
+        "total_monthly_cost": stats.total_monthly,
+        "total_yearly_cost": stats.total_yearly,
+        "annual_projection": (stats.total_monthly * 12) + stats.total_yearly,
+        "category_breakdown": stats.category_breakdown,
         "unused_subscriptions_count": unused_count,
         "optimization_potential": unused_count * 15.0,
-        "active_subscriptions": len([sub for sub in subscriptions if sub.status == "active"]),
-        "total_subscriptions": len(subscriptions)
-    }
+        "active_subscriptions": stats.active_subscriptions,
+        "total_subscriptions": stats.total_subscriptions
+    })
 
 @app.get("/api/users/{user_id}/subscription-status")
-async def get_subscription_status(user_id: str):
-    user = db.get_user(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
+async def get_subscription_status(user: User = Depends(valid_user_id)):
     return {
         "plan": user.plan,
         "ai_detections_used": user.ai_detections_used,
         "ai_detections_limit": user.ai_detections_limit,
-        "can_use_ai": db.can_use_ai_detection(user_id),
+        "can_use_ai": db.can_use_ai_detection(user.id),
         "subscription_expires_at": user.subscription_expires_at,
         "stripe_customer_id": user.stripe_customer_id
     }
@@ -351,23 +368,19 @@ async def get_pricing():
     }
 
 @app.post("/api/users/{user_id}/create-payment-intent")
-async def create_payment_intent(user_id: str, payment_data: PaymentCreate):
-    user = db.get_user(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
+async def create_payment_intent(payment_data: PaymentCreate, user: User = Depends(valid_user_id)):
     if user.plan == payment_data.plan:
         raise HTTPException(status_code=400, detail=f"User already has {payment_data.plan} plan")
     
     try:
         payment_intent_data = await stripe_service.create_payment_intent(
-            user_id=user_id,
+            user_id=user.id,
             payment_data=payment_data,
             customer_id=user.stripe_customer_id
         )
         
         payment = Payment(
-            user_id=user_id,
+            user_id=user.id,
             stripe_payment_intent_id=payment_intent_data["payment_intent_id"],
             amount=payment_intent_data["amount"],
             currency=payment_data.currency,
@@ -426,8 +439,5 @@ async def confirm_payment(payment_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/users/{user_id}/payments", response_model=List[Payment])
-async def get_user_payments(user_id: str):
-    user = db.get_user(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    return db.get_user_payments(user_id)
+async def get_user_payments(user: User = Depends(valid_user_id)):
+    return db.get_user_payments(user.id)
@@ -2,7 +2,10 @@ from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 from enum import Enum
-import uuid
+import uuid_utils
+
+def new_id() -> str:
+    return str(uuid_utils.uuid7())
 
 class SubscriptionStatus(str, Enum):
     ACTIVE = "active"
@@ -47,7 +50,7 @@ class PaymentStatus(str, Enum):
     refunded = "refunded"
 
 class Subscription(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     user_id: str
     name: str
     company: str
@@ -63,7 +66,7 @@ class Subscription(BaseModel):
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 class BillNegotiation(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     user_id: str
     subscription_id: Optional[str] = None
     service_name: str
@@ -76,7 +79,7 @@ class BillNegotiation(BaseModel):
     completed_at: Optional[datetime] = None
 
 class User(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     email: str
     name: str
     currency: Currency = Currency.USD
@@ -98,8 +101,17 @@ class SavingsReport(BaseModel):
     total_subscriptions: int
     active_subscriptions: int
 
+class UserStats(BaseModel):
+    user_id: str
+    total_monthly: float = 0
+    total_yearly: float = 0
+    active_subscriptions: int = 0
+    total_subscriptions: int = 0
+    category_breakdown: Dict[SubscriptionCategory, Dict[str, float]] = Field(default_factory=dict)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
 class PriceAlert(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     user_id: str
     subscription_id: str
     old_price: float
@@ -117,13 +129,16 @@ class SubscriptionCreate(BaseModel):
     next_billing_date: datetime
     category: SubscriptionCategory
 
+class BatchSubscriptionsRequest(BaseModel):
+    user_ids: List[str]
+
 class BillNegotiationCreate(BaseModel):
     service_name: str
     current_amount: float
     target_amount: Optional[float] = None
 
 class Payment(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=new_id)
     user_id: str
     stripe_payment_intent_id: str
     amount: float
@@ -1,4 +1,5 @@
 import stripe
+import asyncio
 import os
 from typing import Dict, Any, Optional
 from fastapi import HTTPException
@@ -15,6 +16,7 @@ class StripeService:
             self.enabled = False
         else:
             stripe.api_key = stripe_key
+            stripe.default_http_client = stripe.RequestsClient(timeout=10)
             self.enabled = True
         
         self.plan_prices = {
@@ -28,6 +30,15 @@ class StripeService:
                 "JPY": 1499.00
             }
         }
+        
+        # Stripe expects amounts in the smallest currency unit; JPY has no minor unit
+        self.plan_prices_minor = {
+            plan: {
+                currency: int(round(price)) if currency == "JPY" else int(round(price * 100))
+                for currency, price in prices.items()
+            }
+            for plan, prices in self.plan_prices.items()
+        }
     
     async def create_customer(self, email: str, name: str) -> Optional[str]:
         """Create a Stripe customer"""
@@ -35,7 +46,8 @@ class StripeService:
             return None
         
         try:
-            customer = stripe.Customer.create(
+            customer = await asyncio.to_thread(
+                stripe.Customer.create,
                 email=email,
                 name=name
             )
@@ -51,11 +63,7 @@ class StripeService:
         
         try:
             amount = self.plan_prices[payment_data.plan][payment_data.currency]
-            
-            if payment_data.currency != "JPY":
-                stripe_amount = int(amount * 100)
-            else:
-                stripe_amount = int(amount)
+            stripe_amount = self.plan_prices_minor[payment_data.plan][payment_data.currency]
             
             intent_data = {
                 "amount": stripe_amount,
@@ -69,7 +77,7 @@ class StripeService:
             if customer_id:
                 intent_data["customer"] = customer_id
             
-            payment_intent = stripe.PaymentIntent.create(**intent_data)
+            payment_intent = await asyncio.to_thread(stripe.PaymentIntent.create, **intent_data)
             
             return {
                 "client_secret": payment_intent.client_secret,
@@ -88,7 +96,7 @@ class StripeService:
             return {"status": "disabled"}
         
         try:
-            payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+            payment_intent = await asyncio.to_thread(stripe.PaymentIntent.retrieve, payment_intent_id)
             return {
                 "status": payment_intent.status,
                 "amount": payment_intent.amount,